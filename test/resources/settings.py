@@ -193,6 +193,11 @@ DEBUG = False
 # Whether a user's session cookie expires when the Web browser is closed.
 SESSION_EXPIRE_AT_BROWSER_CLOSE = True
 
+# Sessions here only ever carry the cart id and download credentials,
+# so the signed-cookie backend keeps session traffic out of the
+# database entirely.
+SESSION_ENGINE = 'django.contrib.sessions.backends.signed_cookies'
+
 SITE_ID = 1
 
 # If you set this to False, Django will make some optimizations so as not
@@ -224,10 +229,33 @@ DATABASES = {
         "HOST": "",
         # Set to empty string for default. Not used with sqlite3.
         "PORT": "",
+        # Keep the test database in memory.
+        "TEST": {
+            "NAME": ":memory:",
+        },
     }
 }
 
 
+def _sqlite_pragmas(sender, connection, **kwargs):
+    """
+    Durability is worthless to a throwaway test database, so trade it
+    for commit latency.
+    """
+    if connection.vendor == 'sqlite':
+        cursor = connection.cursor()
+        cursor.execute('PRAGMA synchronous=OFF')
+        cursor.execute('PRAGMA journal_mode=MEMORY')
+        cursor.execute('PRAGMA temp_store=MEMORY')
+
+try:
+    from django.db.backends.signals import connection_created
+except ImportError:
+    pass
+else:
+    connection_created.connect(_sqlite_pragmas)
+
+
 #########
 # PATHS #
 #########
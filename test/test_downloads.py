@@ -1,15 +1,19 @@
 import os.path
 import shutil
+import tempfile
 try:
     from unittest import mock
 except ImportError:  # python2
     import mock
+try:
+    from functools import lru_cache
+except ImportError:  # python2
+    from django.utils.lru_cache import lru_cache
 
 from django import test
 from django.conf import settings
 from django.contrib import admin
 from django.contrib.auth.models import User
-from django.contrib.messages import get_messages
 from django.contrib.messages.storage.fallback import FallbackStorage
 from django.contrib.sessions.middleware import SessionMiddleware
 from django.core.exceptions import PermissionDenied
@@ -21,11 +25,10 @@ from mezzanine.pages.middleware import PageMiddleware
 from mezzanine.pages.views import page as mezzanine_page_view
 from cartridge.shop.checkout import CHECKOUT_STEP_LAST
 from cartridge.shop.models import (
-    Cart, Order, OrderItem, Product, ProductOption, ProductVariation)
+    Cart, Order, OrderItem, Product, ProductVariation)
 from cartridge.shop.views import checkout_steps
 
 from bs4 import BeautifulSoup
-from django_downloadview.test import temporary_media_root
 
 from cartridge_downloads.admin import DownloadAdmin
 from cartridge_downloads.page_processors import (
@@ -39,16 +42,25 @@ from cartridge_downloads.utils import transact, session_downloads
 
 import testbase
 
+# RequestFactory and SessionMiddleware hold no per-request state, so
+# one instance of each can serve every test.
+_request_factory = test.RequestFactory()
+_session_middleware = SessionMiddleware()
+
+
+@lru_cache(maxsize=1)
+def _download_admin_form():
+    """ Build the DownloadAdmin form class once for the whole module. """
+    return DownloadAdmin(Download, admin.AdminSite()).get_form(mock.Mock())
+
+
 class DownloadModelTests(test.TestCase):
     @classmethod
     def setUpClass(cls):
-        cls.download = Download.objects.get_or_create(
-            file='/path/to/fake/file.ext')[0]
+        cls.download = Download.objects.create(
+            file='/path/to/fake/file.ext')
 
-        site = admin.AdminSite()
-        download_admin = DownloadAdmin(Download, site)
-        request = mock.Mock()
-        cls.download_form = download_admin.get_form(request)
+        cls.download_form = _download_admin_form()
 
         super(DownloadModelTests, cls).setUpClass()
 
@@ -99,9 +111,9 @@ class TransactionModelTests(test.TestCase):
 
 class BillshipHandlerTests(test.TestCase, testbase.DownloadTestMixin):
     def setUp(self):
-        self.request = test.RequestFactory().get('/')
+        self.request = _request_factory.get('/')
         self.request.cart = Cart.objects.create()
-        SessionMiddleware().process_request(self.request)
+        _session_middleware.process_request(self.request)
         self.request.session.save()
 
         digital_product_variation = ProductVariation.objects.create(
@@ -112,14 +124,8 @@ class BillshipHandlerTests(test.TestCase, testbase.DownloadTestMixin):
         self.request.cart.add_item(digital_product_variation, 5)
 
     @classmethod
-    def setUpClass(cls):
-        option = ProductOption.objects.create(type=1, name='Download Only')
-        option.save()
-
-        cls.product = Product.objects.create()
-        cls.product.save()
-
-        super(BillshipHandlerTests, cls).setUpClass()
+    def setUpTestData(cls):
+        cls.create_shop_fixtures()
 
     def test_cartridge_cart_is_download_only(self):
         billship_handler(self.request, mock.Mock())
@@ -140,27 +146,26 @@ class BillshipHandlerTests(test.TestCase, testbase.DownloadTestMixin):
 
 class OrderHandlerTests(test.TestCase, testbase.DownloadTestMixin):
     @classmethod
-    def setUpClass(cls):
-        option = ProductOption.objects.create(type=1, name='Download Only')
-        option.save()
+    def setUpTestData(cls):
+        # These fixtures are shared across test methods. Only database
+        # state is rolled back between tests, so tests must not mutate
+        # them in place.
+        cls.create_shop_fixtures()
+
+        cls.download = Download.objects.create()
+        cls.download.products.add(cls.product)
 
-        super(OrderHandlerTests, cls).setUpClass()
+        cls.variation = ProductVariation.objects.create(
+            sku=testbase.next_sku(), product=cls.product)
 
     def setUp(self):
+        # The order is created per-test because order_handler modifies
+        # it in place.
         self.order = Order.objects.create()
-        self.product = Product.objects.create()
-
-        self.download = Download.objects.create()
-        self.download.products.add(self.product)
-        self.download.save()
-
-        self.variation = ProductVariation.objects.create(
-            sku=self.sku, product=self.product)
-
         OrderItem.objects.create(order=self.order, sku=self.variation.sku)
 
-        self.request = test.RequestFactory().get('/')
-        SessionMiddleware().process_request(self.request)
+        self.request = _request_factory.get('/')
+        _session_middleware.process_request(self.request)
         self.request.session.save()
         self.request.cart = Cart.objects.create()
         self.request.cart.add_item(self.variation, 1)
@@ -173,8 +178,10 @@ class OrderHandlerTests(test.TestCase, testbase.DownloadTestMixin):
         """
         All products are digital and all variations are download_only.
         """
-        self.variation.option1 = 'Download Only'
-        self.variation.save()
+        # Update in the database rather than through cls.variation so
+        # the shared instance is left untouched.
+        ProductVariation.objects.filter(pk=self.variation.pk).update(
+            option1='Download Only')
 
         self.request.is_download_only = True
 
@@ -189,7 +196,8 @@ class OrderHandlerTests(test.TestCase, testbase.DownloadTestMixin):
         """
         self.request.is_download_only = False
 
-        order_handler(self.request, mock.Mock(), self.order)
+        with self.assertQueryBudget(25):
+            order_handler(self.request, mock.Mock(), self.order)
 
         self.assertTrue(self.product_is_download_purchase)
         self.assertEqual(self.order.status, 1)
@@ -197,7 +205,6 @@ class OrderHandlerTests(test.TestCase, testbase.DownloadTestMixin):
     def test_not_digital(self):
         """ Non-digital products. """
         self.product.downloads.clear()
-        self.product.save()
 
         self.request.is_download_only = False
 
@@ -209,14 +216,13 @@ class OrderHandlerTests(test.TestCase, testbase.DownloadTestMixin):
 
 class TestOrderConfirmationEmail(test.TestCase):
     def test_cartridge_order(self):
-        request = test.RequestFactory().post(
+        request = _request_factory.post(
             '/', data={'step': CHECKOUT_STEP_LAST})
-        request.user = User.objects.get_or_create(pk=1)[0]
+        request.user = User.objects.create(pk=1, username='test')
 
         product = Product.objects.create()
-        product.save()
 
-        SessionMiddleware().process_request(request)
+        _session_middleware.process_request(request)
 
         def setup_cart():
             request.cart = Cart.objects.create()
@@ -237,7 +243,6 @@ class TestOrderConfirmationEmail(test.TestCase):
 
         download = Download.objects.create()
         download.products.add(product)
-        download.save()
 
         setup_cart()
 
@@ -251,21 +256,19 @@ class TestFormConfirmationEmail(test.TestCase):
     """ HACK Separate classes avoids segmentation fault. """
     def test_mezzanine_form(self):
         page = Form.objects.create(slug='my-form')
-        page.save()
 
         field = Field.objects.create(
             form=page,
             field_type=3,
             required=False)
-        field.save()
 
         page_middleware = PageMiddleware()
 
-        request = test.RequestFactory().post(
+        request = _request_factory.post(
             '/my-form', data={'field_1': 'somebody@example.com'})
-        request.user = User.objects.get_or_create(pk=1)[0]
+        request.user = User.objects.create(pk=1, username='test')
 
-        SessionMiddleware().process_request(request)
+        _session_middleware.process_request(request)
         request.session.save()
 
         self.assertEqual(len(mail.outbox), 0,)
@@ -276,7 +279,6 @@ class TestFormConfirmationEmail(test.TestCase):
 
         download = Download.objects.create()
         download.forms.add(page)
-        download.save()
 
         page_middleware.process_view(request, mezzanine_page_view, {}, {})
         self.assertEqual(len(mail.outbox), 2)
@@ -284,62 +286,71 @@ class TestFormConfirmationEmail(test.TestCase):
 
 
 class OverrideMezzanineFormProcessorTests(test.TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.page = Form.objects.create()
+
     def setUp(self):
         # Must post some data or the form will not be bound.
-        self.request = test.RequestFactory().post('/', data={'not': 'None'})
+        self.request = _request_factory.post('/', data={'not': 'None'})
 
-        SessionMiddleware().process_request(self.request)
+        _session_middleware.process_request(self.request)
         self.request.session.save()
 
-        self.page = Form.objects.create()
-        self.page.save()
-
     def test_downloads(self):
         download = Download.objects.create(file='test_downloads.ext')
         self.page.downloads.add(download)
-        self.page.save()
 
         response = override_mezzanine_form_processor(self.request, self.page)
         self.assertEqual(response.status_code, 302)
         self.assertEqual(response.url, '/downloads/')
 
     def test_no_downloads(self):
-        response = override_mezzanine_form_processor(self.request, self.page)
+        # An in-memory page is enough here: the processor only feeds
+        # page.form to FormForForm and checks its downloads relation,
+        # so there is no need to insert a real Form row.
+        page = mock.MagicMock()
+        page.form.fields.visible.return_value = []
+        page.form.downloads.exists.return_value = False
+
+        response = override_mezzanine_form_processor(self.request, page)
         self.assertIsNone(response)
         self.assertNotIn('cartridge_downloads', self.request.session)
 
 
-class SignalTests(test.TestCase):
+class SignalTests(test.TestCase, testbase.DownloadTestMixin):
     @classmethod
     def setUpClass(cls):
         cls.surviving_product = Product.objects.create()
-        cls.surviving_product.save()
 
         cls.surviving_download = Download.objects.create(slug='survivor')
         cls.surviving_download.products.add(cls.surviving_product)
-        cls.surviving_download.save()
 
         super(SignalTests, cls).setUpClass()
 
     def setUp(self):
         self.doomed_download = Download.objects.create(slug='doomed')
-        self.doomed_download.save()
 
     def test_purge_downloads_on_delete(self):
         """ When products are deleted, remove downloads with no product. """
         doomed_product = Product.objects.create()
-        doomed_product.save()
 
-        self.surviving_download.products.add(doomed_product)
-        self.surviving_download.save()
-
-        self.doomed_download.products.add(doomed_product)
-        self.doomed_download.save()
+        # One INSERT for both through rows, where .add() would issue a
+        # SELECT plus INSERT per link.
+        Download.products.through.objects.bulk_create([
+            Download.products.through(
+                download_id=self.surviving_download.pk,
+                product_id=doomed_product.pk),
+            Download.products.through(
+                download_id=self.doomed_download.pk,
+                product_id=doomed_product.pk),
+        ])
 
         self.assertTrue(Download.objects.filter(slug='doomed').exists())
 
-        doomed_product.delete()
-        doomed_product.save()
+        # The budget covers the cascade plus the purge signal.
+        with self.assertQueryBudget(50):
+            doomed_product.delete()
 
         self.assertTrue(Download.objects.filter(slug='survivor').exists())
         self.assertFalse(Download.objects.filter(slug='doomed').exists())
@@ -347,54 +358,70 @@ class SignalTests(test.TestCase):
     def test_purge_downloads_on_change(self):
         """ When downloads are removed from a ManyToManyField, purge. """
         product = Product.objects.create()
-        product.save()
-
-        self.surviving_download.products.add(product)
-        self.surviving_download.save()
 
-        self.doomed_download.products.add(product)
-        self.doomed_download.save()
+        Download.products.through.objects.bulk_create([
+            Download.products.through(
+                download_id=self.surviving_download.pk,
+                product_id=product.pk),
+            Download.products.through(
+                download_id=self.doomed_download.pk,
+                product_id=product.pk),
+        ])
 
         self.assertTrue(Download.objects.filter(slug='doomed').exists())
 
         product.downloads.remove(self.doomed_download)
-        product.save()
 
         self.assertTrue(Download.objects.filter(slug='survivor').exists())
         self.assertFalse(Download.objects.filter(slug='doomed').exists())
 
 
-class DownloadViewTests(test.TestCase):
+class DownloadViewTests(test.TestCase, testbase.DownloadTestMixin):
+    basename = 'download_file.txt'
+
     @classmethod
     def setUpClass(cls):
-        cls.request = test.RequestFactory().get('/')
-        SessionMiddleware().process_request(cls.request)
-        cls.request.session.save()
+        # Share one temporary MEDIA_ROOT across the class instead of a
+        # mkdtemp/rmtree cycle per test. The download rows tied to it
+        # are still created per-test and rolled back.
+        cls._media_root = tempfile.mkdtemp()
+        cls._media_override = test.override_settings(
+            MEDIA_ROOT=cls._media_root)
+        cls._media_override.enable()
+
+        for basename in (cls.basename, 'another_file.txt'):
+            open(os.path.join(cls._media_root, basename), 'a').close()
+
+        cls.request = _request_factory.get('/')
+        _session_middleware.process_request(cls.request)
         setattr(cls.request, '_messages', FallbackStorage(cls.request))
 
-        cls.product = Product.objects.create()
-        cls.product.save()
-
         super(DownloadViewTests, cls).setUpClass()
 
-    def _set_up_download_file(self, basename):
-        temp_file = os.path.join(settings.MEDIA_ROOT, basename)
-        with open(temp_file, 'a'):
-            os.utime(temp_file, None)
+    @classmethod
+    def tearDownClass(cls):
+        super(DownloadViewTests, cls).tearDownClass()
+        cls._media_override.disable()
+        shutil.rmtree(cls._media_root)
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.product = Product.objects.create()
 
-        download = Download.objects.create(file=temp_file)
-        download.products.add(self.product)
-        download.save()
+        cls.order = Order.objects.create()
 
-        return download
+    def _set_up_download_file(self, basename):
+        return Download.objects.create(
+            file=os.path.join(settings.MEDIA_ROOT, basename))
 
     def _set_up(self):
-        """ Run this from within test method to use temporary media root. """
-        self.basename = 'download_file.txt'
         self.download = self._set_up_download_file(self.basename)
+        another_download = self._set_up_download_file('another_file.txt')
 
-        order = Order.objects.create()
-        order.save()
+        Download.products.through.objects.bulk_create([
+            Download.products.through(
+                download_id=download.pk, product_id=self.product.pk)
+            for download in (self.download, another_download)])
 
         transaction = transact(self.request)
 
@@ -402,16 +429,16 @@ class DownloadViewTests(test.TestCase):
             download=self.download,
             transaction=transaction,
             product=self.product,
-            order=order)
-        self.purchase.save()
+            order=self.order)
 
-        another_download = self._set_up_download_file('another_file.txt')
         another_purchase = Purchase.objects.create(
             download=another_download,
             transaction=transaction,
             product=self.product,
-            order=order)
-        another_purchase.save()
+            order=self.order)
+
+        # Save once, after transact() has written the credentials.
+        self.request.session.save()
 
     def test_authenticate(self):
         credentials = Transaction.objects.create().make_credentials()
@@ -425,10 +452,9 @@ class DownloadViewTests(test.TestCase):
             self.assertEqual(session['id'], credentials['id'])
             self.assertEqual(session['token'], credentials['token'])
 
-    @temporary_media_root()
     def test_index(self):
         self._set_up()
-        self.request.user = User.objects.get_or_create(pk=1)[0]
+        self.request.user = User.objects.create(pk=1, username='test')
 
         response = views.index(self.request)
         self.assertEqual(response.status_code, 200)
@@ -437,16 +463,15 @@ class DownloadViewTests(test.TestCase):
         self.assertEqual(
             len(soup.find_all('a', href='/downloads/download_file.txt')), 1)
 
-    @temporary_media_root()
     def test_download(self):
         self._set_up()
 
-        response = views.download(self.request, slug=self.download.slug)
+        with self.assertQueryBudget(25):
+            response = views.download(self.request, slug=self.download.slug)
         self.assertEqual(response.status_code, 200)
         self.assertTrue(response.attachment)
         self.assertEqual(response.get_basename(), self.basename)
 
-    @temporary_media_root()
     def test_cookie_not_found(self):
         self._set_up()
 
@@ -457,7 +482,6 @@ class DownloadViewTests(test.TestCase):
         with self.assertRaises(PermissionDenied):
             views.download(self.request, slug=self.download.slug)
 
-    @temporary_media_root()
     def test_acquisition_does_not_exist_unauthorized(self):
         """
         The file may exist, but the user is not authorized to access it.
@@ -465,16 +489,16 @@ class DownloadViewTests(test.TestCase):
         self._set_up()
 
         different_file = os.path.join(settings.MEDIA_ROOT, 'different.txt')
-        shutil.copy(
+        # A hard link is enough -- the test only needs the file to exist
+        # under a second name and never reads its (empty) contents.
+        os.link(
             os.path.join(settings.MEDIA_ROOT, self.basename), different_file)
 
         different_download = Download.objects.create(file=different_file)
-        different_download.save()
 
         with self.assertRaises(Acquisition.DoesNotExist):
             views.download(self.request, slug=different_download.slug)
 
-    @temporary_media_root()
     def test_download_limit(self):
         self._set_up()
 
@@ -486,7 +510,11 @@ class DownloadViewTests(test.TestCase):
         self.assertEqual(response.status_code, 302)
         self.assertFalse(hasattr(response, 'attachment'))
 
-        messages = [m.message for m in get_messages(self.request)]
+        # Read the installed storage directly; the tests attach
+        # FallbackStorage themselves, so there is no cookie fallback to
+        # exercise.
+        messages = [
+            m.message for m in self.request._messages._queued_messages]
         self.assertEqual(
             messages,
             ['Download Limit Exceeded. Please contact us for assistance.'])
@@ -494,22 +522,16 @@ class DownloadViewTests(test.TestCase):
 
 class OverrideViewTests(test.TestCase, testbase.DownloadTestMixin):
     @classmethod
-    def setUpClass(cls):
-        option = ProductOption.objects.create(type=1, name='Download Only')
-        option.save()
-
-        cls.product = Product.objects.create()
-        cls.product.save()
-
-        super(OverrideViewTests, cls).setUpClass()
+    def setUpTestData(cls):
+        cls.create_shop_fixtures()
 
     def setUp(self):
-        self.request = test.RequestFactory().get('/')
-        SessionMiddleware().process_request(self.request)
+        self.request = _request_factory.get('/')
+        _session_middleware.process_request(self.request)
         self.request.session.save()
 
     def test_cartridge_product(self):
-        self.request.user = User.objects.get_or_create(pk=1)[0]
+        self.request.user = User.objects.create(pk=1, username='test')
 
         response = override_cartridge.product(self.request, self.product.slug)
         product_form = response.context_data['add_product_form']
@@ -520,18 +542,21 @@ class OverrideViewTests(test.TestCase, testbase.DownloadTestMixin):
     def test_cartridge_cart(self):
         self.request.cart = Cart.objects.create()
 
-        conventional_product_variation = ProductVariation.objects.create(
-            sku=self.sku, product=self.product)
-
-        digital_product_variation = ProductVariation.objects.create(
+        # Batch both variations into a single INSERT. Cart.add_item only
+        # needs the sku and product, so skipping the post-save pk lookup
+        # is fine here.
+        conventional_product_variation = ProductVariation(
             sku=self.sku, product=self.product)
-        digital_product_variation.option1 = 'Download Only'
-        digital_product_variation.save()
+        digital_product_variation = ProductVariation(
+            sku=self.sku, product=self.product, option1='Download Only')
+        ProductVariation.objects.bulk_create(
+            [conventional_product_variation, digital_product_variation])
 
         self.request.cart.add_item(conventional_product_variation, 5)
         self.request.cart.add_item(digital_product_variation, 5)
 
-        response = override_cartridge.cart(self.request, 'cart')
+        with self.assertQueryBudget(75):
+            response = override_cartridge.cart(self.request, 'cart')
         cart_formset = response.context_data['cart_formset']
 
         conventional_form = cart_formset[0]
@@ -545,9 +570,9 @@ class OverrideViewTests(test.TestCase, testbase.DownloadTestMixin):
         self.assertEqual(digital_form.instance.quantity, 1)
 
     def test_filebrowser_delete(self):
-        download = Download.objects.get_or_create(slug='somefile.txt')[0]
+        download = Download.objects.create(slug='somefile.txt')
 
-        self.request.user = User.objects.get_or_create(pk=1)[0]
+        self.request.user = User.objects.create(pk=1, username='test')
         setattr(self.request, '_messages', FallbackStorage(self.request))
         self.request.GET = self.request.GET.copy()
         self.request.GET['filename'] = download.slug
@@ -556,7 +581,11 @@ class OverrideViewTests(test.TestCase, testbase.DownloadTestMixin):
 
         self.assertEqual(response.status_code, 302)
 
-        messages = [m.message for m in get_messages(self.request)]
+        # Read the installed storage directly; the tests attach
+        # FallbackStorage themselves, so there is no cookie fallback to
+        # exercise.
+        messages = [
+            m.message for m in self.request._messages._queued_messages]
         self.assertEqual(
             messages,
             ["To delete somefile.txt you must delete it's associated product first."])
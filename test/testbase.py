@@ -1,10 +1,47 @@
+import contextlib
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from cartridge.shop.models import Product, ProductOption
+
 SKU = -1
 
 
+def next_sku():
+    global SKU
+    SKU += 1
+    return SKU
+
+
 class DownloadTestMixin(object):
 
     @property
     def sku(self):
-        global SKU
-        SKU += 1
-        return SKU
+        return next_sku()
+
+    @classmethod
+    def create_shop_fixtures(cls):
+        """
+        Create the 'Download Only' option and a product. Call from
+        setUpTestData so the rows are inserted once per class and
+        rolled back at class teardown.
+        """
+        cls.option = ProductOption.objects.create(
+            type=1, name='Download Only')
+        cls.product = Product.objects.create()
+
+    @contextlib.contextmanager
+    def assertQueryBudget(self, limit):
+        """
+        Fail if the block issues more than ``limit`` queries.
+
+        The budgets are deliberately generous ceilings: they exist to
+        catch reintroduced per-row saves and N+1 loops, not to pin
+        exact counts.
+        """
+        with CaptureQueriesContext(connection) as queries:
+            yield
+        self.assertLessEqual(
+            len(queries), limit,
+            '%s queries executed, budget was %s' % (len(queries), limit))